@@ -27,10 +27,10 @@ Some information was used from dmmut61e utility by Steffen Vogel
 from __future__ import print_function
 import serial
 import sys
-from decimal import Decimal
 import struct
 import logging
 import datetime
+from collections import namedtuple
 
 """
 baud rate 19230
@@ -55,18 +55,30 @@ def test_bit(int_type, offset):
     mask = 1 << offset
     return bool(int_type & mask)
     
-def get_bits(int_type, template):
+def get_constant_bits(template):
+    """Returns (mask, value) of the bits that have a constant value in the
+    template, the bits are in the same order as in get_bits()."""
+    mask = 0
+    value = 0
+    for i in range(7):
+        bit_name = template[6-i]
+        if bit_name in (0,1):
+            mask |= 1 << i
+            value |= bit_name << i
+    return mask, value
+
+def get_bits(int_type, template, constant_bits=None):
+    # constant_bits can be given to avoid computing it again for every byte
+    if constant_bits is None:
+        constant_bits = get_constant_bits(template)
+    mask, value = constant_bits
+    if (int_type ^ value) & mask:
+        raise ValueError
     bits = {}
     for i in range(7):
-        bit = test_bit(int_type, i)
         bit_name = template[6-i]
-        #print(bit, bit_name, i)
-        if bit_name in (0,1) and bit==bit_name:
-            continue
-        elif bit_name in (0,1):
-            raise ValueError
-        else:
-           bits[bit_name] = bit
+        if bit_name not in (0,1):
+            bits[bit_name] = test_bit(int_type, i)
     return bits
 
 RANGE_VOLTAGE = {
@@ -88,10 +100,6 @@ RANGE_CURRENT_AUTO_MA = {
     0b0110001: (1e-3, 2, "mA"), #2
 }
 
-RANGE_CURRENT_AUTO = { #2-range auto A *It includes auto μA, mA, 22.000A/220.00A, 220.00A/2200.0A.
-    0b0110000: "Lower Range (IVSL)", #Current measurement input for 220μA, 22mA.
-    0b0110001: "Higher Range (IVSH)" #Current measurement input for 2200μA, 220mA and 22A modes.
-} 
 RANGE_CURRENT_22A = { 0b0110000: (1e0, 3, "A") } #22.000 A
 
 RANGE_CURRENT_MANUAL = {
@@ -180,6 +188,26 @@ DIGITS = {
     0b0111001: 9,
 }
 
+def _get_function_table():
+    """FUNCTION and its range dicts as lists indexed by the byte value."""
+    table = [None]*128
+    for d_function, (mode, ranges, unit) in FUNCTION.items():
+        if ranges is not None:
+            range_table = [None]*128
+            for d_range, m_range in ranges.items():
+                range_table[d_range] = m_range
+            ranges = range_table
+        table[d_function] = (mode, ranges, unit)
+    return table
+
+_FUNCTION_TABLE = _get_function_table()
+
+# powers of ten for the number of decimals
+_POW10 = (1, 10, 100, 1000, 10000)
+
+# DIGITS as a bytes.translate() table, invalid digit bytes become 0xFF
+_DIGIT_TRANS = bytes(bytearray(DIGITS.get(byte, 0xFF) for byte in range(256)))
+
 STATUS = [
     0, 1, 1,
     "Judge", # 1-°C, 0-°F.
@@ -219,163 +247,283 @@ OPTION4 = [
     "LPF", #low-pass-filter feature is activated.
 ]
 
-def parse(packet):
-    #packet = [ord(byte) for byte in packet]
-    d_range, \
-    d_digit4, d_digit3, d_digit2, d_digit1, d_digit0, \
-    d_function, d_status, \
-    d_option1, d_option2, d_option3, d_option4 = struct.unpack("B"*12, packet)
-    
-    mode = FUNCTION[d_function][0]
-    m_range =  FUNCTION[d_function][1][d_range]
-    unit = FUNCTION[d_function][2]
-    
-    options = {}
-    d_options = (d_status, d_option1, d_option2, d_option3, d_option4)
-    OPTIONS = (STATUS, OPTION1, OPTION2, OPTION3, OPTION4)
-    for d_option, OPTION in zip(d_options, OPTIONS):
-        bits = get_bits(d_option, OPTION)
-        options.update(bits)
-        
+# the bits of each status/option byte, already converted to the values used
+# in the results
+StatusBits = namedtuple("StatusBits", "judge sign battery_low overload")
+Option1Bits = namedtuple("Option1Bits", "peak relative")
+Option2Bits = namedtuple("Option2Bits", "underload")
+Option3Bits = namedtuple("Option3Bits", "current auto vahz")
+Option4Bits = namedtuple("Option4Bits", "vbar hold")
+
+def _decode_status(bits):
+    return StatusBits(bits["Judge"], bits["Sign"], bits["BATT"], bits["OL"])
+
+def _decode_option1(bits):
+    peak = None
+    if bits["MAX"]:
+        peak = "max"
+    elif bits["MIN"]:
+        peak = "min"
+    # relative measurement mode, received value is actual!
+    return Option1Bits(peak, bits["REL"])
+
+def _decode_option2(bits):
+    return Option2Bits(bits["UL"])
+
+def _decode_option3(bits):
     current = None
-    if options["AC"] and options["DC"]:
+    if bits["AC"] and bits["DC"]:
         raise ValueError
-    elif options["DC"]:
+    elif bits["DC"]:
         current = "AC"
-    elif options["AC"]:
+    elif bits["AC"]:
         current = "DC"
+    return Option3Bits(current, bits["AUTO"], bits["VAHZ"])
+
+def _decode_option4(bits):
+    # data hold mode, received value is actual!
+    return Option4Bits(bits["VBAR"], bits["Hold"])
+
+def _get_bits_table(template, decode):
+    """Decodes every possible 7-bit value of a byte in advance.
+    Entries for values that are not valid are None."""
+    constant_bits = get_constant_bits(template)
+    table = []
+    for int_type in range(128):
+        try:
+            table.append(decode(get_bits(int_type, template, constant_bits)))
+        except ValueError:
+            table.append(None)
+    return table
+
+# only the 7 data bits are used, the same as in get_bits()
+_STATUS_TABLE = _get_bits_table(STATUS, _decode_status)
+_OPTION1_TABLE = _get_bits_table(OPTION1, _decode_option1)
+_OPTION2_TABLE = _get_bits_table(OPTION2, _decode_option2)
+_OPTION3_TABLE = _get_bits_table(OPTION3, _decode_option3)
+_OPTION4_TABLE = _get_bits_table(OPTION4, _decode_option4)
+
+# parsed packet, the results are immutable so they can be cached
+Results = namedtuple("Results", ["value", "unit",
+                                 "display_value", "display_unit",
+                                 "mode", "current", "peak", "relative", "hold",
+                                 #"range",
+                                 "operation", "battery_low"])
+
+# the 12 packet bytes without the digits, those are decoded separately,
+# compiled once instead of on every packet
+_PACKET = struct.Struct("B5x6B")
+
+def _decode_mode(d_range, d_function, d_status,
+                 d_option1, d_option2, d_option3, d_option4):
+    """Decodes everything in the packet except the digits."""
+    function = _FUNCTION_TABLE[d_function]
+    if function is None:
+        raise ValueError("unknown function byte %r" % d_function)
+    mode, ranges, unit = function
+    m_range = ranges[d_range]
+    if m_range is None:
+        raise ValueError("unknown range byte %r" % d_range)
+    
+    status = _STATUS_TABLE[d_status & 0x7F]
+    option1 = _OPTION1_TABLE[d_option1 & 0x7F]
+    option2 = _OPTION2_TABLE[d_option2 & 0x7F]
+    option3 = _OPTION3_TABLE[d_option3 & 0x7F]
+    option4 = _OPTION4_TABLE[d_option4 & 0x7F]
+    if None in (status, option1, option2, option3, option4):
+        raise ValueError
         
+    current = option3.current
+    
     operation = "normal"
     # sometimes there a glitch where both UL and OL are enabled in normal operation
     # so no error is raised when it occurs
-    if options["UL"]:
+    if option2.underload:
         operation = "underload"
-    elif options["OL"]:
+    elif status.overload:
         operation = "overload"
         
-    if options["AUTO"]:
+    if option3.auto:
         mrange = "auto"
     else:
         mrange = "manual"
         
-    if options["BATT"]:
-        battery_low = True
-    else:
-        battery_low = False
-    
-    # relative measurement mode, received value is actual!
-    if options["REL"]:
-        relative = True
-    else:
-        relative = False
+    battery_low = status.battery_low
+    relative = option1.relative
+    hold = option4.hold
+    peak = option1.peak
     
-    # data hold mode, received value is actual!
-    if options["Hold"]:
-        hold = True
-    else:
-        hold = False
-        
-    peak = None
-    if options["MAX"]:
-        peak = "max"
-    elif options["MIN"]:
-        peak = "min"
-    
-    if mode == "current" and options["VBAR"]:
+    if mode == "current" and option4.vbar:
         pass
         """Auto μA Current
         Auto mA Current"""
-    elif mode == "current" and not options["VBAR"]:
+    elif mode == "current" and not option4.vbar:
         pass
         """Auto 220.00A/2200.0A
         Auto 22.000A/220.00A"""
     
-    if options["VAHZ"] and not options["Judge"]:
+    if option3.vahz and not status.judge:
         mode = "frequency"
         unit = "Hz"
         m_range = (1e0, 1, "Hz") #2200.0°C
-    elif (options["VAHZ"] or mode == "frequency") and options["Judge"]:
+    elif (option3.vahz or mode == "frequency") and status.judge:
         mode = "duty_cycle"
         unit = "%"
         m_range = (1e0, 1, "%") #2200.0°C
         
-    if mode == "temperature" and options["VBAR"]:
+    if mode == "temperature" and option4.vbar:
         m_range = (1e0, 1, "deg") #2200.0°C
-    elif mode == "temperature" and not options["VBAR"]:
+    elif mode == "temperature" and not option4.vbar:
         m_range = (1e0, 2, "deg") #220.00°C and °F
-        
-    digits = [d_digit4, d_digit3, d_digit2, d_digit1, d_digit0]
-    digits = [DIGITS[digit] for digit in digits]
     
-    display_value = 0
-    for i, digit in zip(range(5), digits):
-        display_value += digit*(10**(4-i))
-        
+    return (mode, unit, m_range, current, operation, battery_low, peak,
+            relative, hold, status.sign)
+
+# the decoded mode is remembered for the packet bytes other than the digits,
+# while measuring they change much less often than the digits
+_MODE_CACHE = {}
+_MODE_CACHE_SIZE = 512
+
+def _parse_packet(packet):
+    #packet = [ord(byte) for byte in packet]
+    d_range, \
+    d_function, d_status, \
+    d_option1, d_option2, d_option3, d_option4 = _PACKET.unpack(packet)
+    
+    key = packet[0:1] + packet[6:12]
+    decoded = _MODE_CACHE.get(key)
+    if decoded is None:
+        decoded = _decode_mode(d_range, d_function, d_status,
+                               d_option1, d_option2, d_option3, d_option4)
+        if len(_MODE_CACHE) >= _MODE_CACHE_SIZE:
+            _MODE_CACHE.clear()
+        _MODE_CACHE[key] = decoded
+    mode, unit, m_range, current, operation, battery_low, peak, \
+    relative, hold, sign = decoded
+    
+    # digit4 ... digit0
+    d_digits = packet[1:6]
+    digits = bytearray(d_digits).translate(_DIGIT_TRANS)
+    if 0xFF in digits:
+        raise ValueError("invalid digit byte in %r" % d_digits)
+    digit4, digit3, digit2, digit1, digit0 = digits
+    display_value = (((digit4*10 + digit3)*10 + digit2)*10 + digit1)*10 + digit0
+    
+    # the decimal point is put into the digit string directly, Decimal is
+    # much slower and does not give anything more here
+    decimals = m_range[1]
+    display_digits = "%0*d" % (decimals + 1, display_value)
+    if decimals:
+        display_digits = "{}.{}".format(display_digits[:-decimals],
+                                        display_digits[-decimals:])
     # negative value
-    if options["Sign"]:
+    if sign and display_value:
         display_value = display_value * -1
+        display_digits = "-" + display_digits
     
-    display_value = Decimal(display_value) / 10**m_range[1]
-    display_value = display_value.quantize(Decimal(1)/10**m_range[1])
     display_unit = m_range[2]
-    value = float(display_value) * m_range[0]
+    value = float(display_value) / _POW10[decimals] * m_range[0]
+    display_value = display_digits
     
     if operation != "normal":
         display_value = ""
         value = ""
-    results = {
-        "value": value,
-        "unit": unit,
-        "display_value": display_value,
-        "display_unit": display_unit,
-        "mode": mode,
-        "current": current,
-        "peak": peak,
-        "relative": relative,
-        "hold": hold,
-        #"range": mrange,
-        "operation": operation,
-        "battery_low": battery_low
-    }
+    results = Results(value, unit, display_value, display_unit, mode,
+                      current, peak, relative, hold, operation, battery_low)
     
     return results
 
+# the multimeter sends the same packet over and over while the reading is
+# steady, so parsed packets are remembered (the cache is simply emptied when
+# it gets full)
+_PARSE_CACHE = {}
+_PARSE_CACHE_SIZE = 256
+
+def parse(packet):
+    key = bytes(packet)
+    results = _PARSE_CACHE.get(key)
+    if results is None:
+        results = _parse_packet(key)
+        if len(_PARSE_CACHE) >= _PARSE_CACHE_SIZE:
+            _PARSE_CACHE.clear()
+        _PARSE_CACHE[key] = results
+    return results
+
 def output_readable(results):
-    operation = results["operation"]
-    battery_low = results["battery_low"]
+    operation = results.operation
+    battery_low = results.battery_low
     if operation == "normal":
-        display_value = results["display_value"]
-        display_unit = results["display_unit"]
+        display_value = results.display_value
+        display_unit = results.display_unit
         line = "{value} {unit}".format(value=display_value, unit=display_unit)
     else:
         line = "-, the measurement is {operation}ed!".format(operation=operation)
     if battery_low:
-        line.append(" Battery low!")
+        line += " Battery low!"
     return line
 
 CSV_FIELDS = ["value", "unit", "mode", "current", "operation", "peak", 
             "battery_low", "relative", "hold"]
-def format_field(results, field_name):
-    value = results[field_name]
-    if field_name == "value":
-        if results["operation"]=="normal":
-            return str(value)
-        else:
-            return ""
-    if value==None:
+# formatters for the types of the CSV fields
+def _format_value(results, field_name):
+    if results.operation=="normal":
+        return str(getattr(results, field_name))
+    else:
+        return ""
+
+def _format_text(results, field_name):
+    value = getattr(results, field_name)
+    if value is None:
         return ""
-    elif value==True:
+    return value
+
+def _format_flag(results, field_name):
+    if getattr(results, field_name):
         return "1"
-    elif value==False:
-        return "0"
-    else:
-        return str(value)
-        
+    return "0"
+
+_FIELD_FORMATS = {
+    "value": _format_value,
+    "unit": _format_text,
+    "mode": _format_text,
+    "current": _format_text,
+    "operation": _format_text,
+    "peak": _format_text,
+    "battery_low": _format_flag,
+    "relative": _format_flag,
+    "hold": _format_flag,
+}
+_CSV_FORMATS = [(field_name, _FIELD_FORMATS[field_name])
+                for field_name in CSV_FIELDS]
+
 def output_csv(results):
-    field_data = [format_field(results, field_name) for field_name in CSV_FIELDS]
+    field_data = [formatter(results, field_name)
+                  for field_name, formatter in _CSV_FORMATS]
     line = ";".join(field_data)
     return line
 
+def read_lines(ser):
+    """Reads the port in chunks and yields the received lines without CR LF.
+    An empty line is yielded when nothing arrives before the port timeout,
+    the same as with ser.readline()."""
+    buf = bytearray()
+    while True:
+        # everything already received, otherwise wait for a single byte so
+        # a line is never held back waiting for the next packet
+        chunk = ser.read(ser.in_waiting or 1)
+        if not chunk:
+            line = bytes(buf).strip()
+            del buf[:]
+            yield line
+            continue
+        buf.extend(chunk)
+        end = buf.find(b"\n")
+        while end >= 0:
+            line = bytes(buf[:end]).strip()
+            del buf[:end+1]
+            yield line
+            end = buf.find(b"\n")
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='Upload time data files.')
@@ -421,34 +569,46 @@ def main():
             file_name = args.file
         else:
             file_name = "measurement_{}.csv".format(timestamp)
-        output_file = open(file_name, "w")
+        # the lines are written through a large buffer, it is flushed when
+        # the file is closed
+        output_file = open(file_name, "wb", 65536)
         logging.info('Writing to file "{}"'.format(file_name))
         header = "timestamp;{}\n".format(";".join(CSV_FIELDS))
-        output_file.write(header)
-    while True:
-        line = ser.readline()
-        line = line.strip()
-        timestamp = datetime.datetime.now()
-        timestamp = timestamp.isoformat(sep=' ')
-        if len(line)==12:
-            try:
-                results = parse(line)
-            except Exception, e:
-                logging.warning('Error "{}" packet from multimeter: "{}"'.format(e, line))
-            if args.mode == 'csv':
-                line = output_csv(results)
-                output_file.write("{};{}\n".format(timestamp, line))
-            elif args.mode == 'readable':
-                pass
+        output_file.write(header.encode("ascii"))
+    # bound once for the read loop
+    now = datetime.datetime.now
+    parse_packet = parse
+    format_csv = output_csv
+    if output_file is not None:
+        write = output_file.write
+    try:
+        for line in read_lines(ser):
+            if len(line)==12:
+                # only packets that are used get a timestamp
+                timestamp = now().isoformat(sep=' ')
+                try:
+                    results = parse_packet(line)
+                except Exception, e:
+                    logging.warning('Error "{}" packet from multimeter: "{}"'.format(e, line))
+                    continue
+                if args.mode == 'csv':
+                    line = format_csv(results)
+                    line = "{};{}\n".format(timestamp, line)
+                    write(line.encode("ascii"))
+                elif args.mode == 'readable':
+                    pass
+                else:
+                    raise NotImplementedError
+                line = output_readable(results)
+                print(timestamp.split(" ")[1], line)
+            elif line:
+                logging.warning('Unknown packet from multimeter: "{}"'.format(line))
             else:
-                raise NotImplementedError
-            line = output_readable(results)
-            print(timestamp.split(" ")[1], line)
-        elif line:
-            logging.warning('Unknown packet from multimeter: "{}"'.format(line))
-        else:
-            logging.warning("No response from multimeter")
-    ser.close()
+                logging.warning("No response from multimeter")
+    finally:
+        if output_file is not None:
+            output_file.close()
+        ser.close()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file